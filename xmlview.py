@@ -10,6 +10,12 @@ from idlelib.WidgetRedirector import WidgetRedirector
 import datetime
 import subprocess
 import platform
+import re
+import collections
+import heapq
+from array import array
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
 
 import logging
 global logger
@@ -371,6 +377,7 @@ class XMLTreeView(tk.Frame, WithCallback):
 		scrollb.grid(row=0, column=1, sticky='nsew')
 		self.tview['yscrollcommand'] = scrollb.set
 		self.xml_tags = []
+		self.tree_elements = {}
 		self.bind("<Visibility>", self.on_visibility)
 
 	def add_tree_items_recursive_debug(self, e, tv_parent):
@@ -413,10 +420,12 @@ class XMLTreeView(tk.Frame, WithCallback):
 					_s.append(' = ')
 				_s.append('{}'.format(e.text))
 		_newe = self.tview.insert(tv_parent, 'end', text=''.join(_s), open=_open)
+		self.tree_elements[_newe] = e
 		if e.attrib:
 			if len(e.attrib):
 				for a in e.attrib:
 					__newe = self.tview.insert(_newe, 'end', text=str(a))
+					self.tree_elements[__newe] = e
 					# logger.debug('add attrib {}'.format(__newe))
 		for ee in e:
 			self.add_tree_items_recursive(ee, _newe)  # subsequent leaves will be closed
@@ -424,6 +433,7 @@ class XMLTreeView(tk.Frame, WithCallback):
 	def update(self, new_root = None):
 		for i in self.tview.get_children():
 			self.tview.delete(i)
+		self.tree_elements = {}
 		if new_root is not None:
 			self.xml_root = new_root
 		if self.xml_root is not None:
@@ -435,6 +445,486 @@ class XMLTreeView(tk.Frame, WithCallback):
 	def on_visibility(self, event):
 		self.update()
 
+	def selected_element(self):
+		for i in self.tview.selection():
+			if i in self.tree_elements:
+				return self.tree_elements[i]
+		return None
+
+
+def indent_xml(e, indent='', step='  '):
+	# one element per line, starting at indent - only element-only content is
+	# touched, text in mixed content, CDATA and comments stays as it is
+	if not len(e):
+		return
+	if (e.text and e.text.strip()) or [c for c in e if c.tail and c.tail.strip()]:
+		return
+	_inner = indent + step
+	e.text = '\n' + _inner
+	for c in e:
+		indent_xml(c, _inner, step)
+		c.tail = '\n' + _inner
+	c.tail = '\n' + indent
+
+
+class XMLSourceMap(object):
+	# where the elements of the parsed tree sit in the text of a TextFrame
+	# - sourceline from the parser is used as is until a subtree is reformatted
+	# - a reformatted subtree becomes a patch: a pair of Tk marks that move with
+	#   the text, plus a line offset (relative to the start mark) per element
+	# - elements past a top level patch are shifted by the lines the patch added
+	markup = (('<!--', '-->'), ('<![CDATA[', ']]>'), ('<?', '?>'), ('<!', '>'), ('<', '>'))
+	tag_delims = re.compile(r'[>"\']')
+	tag_name = re.compile(r'[^\s/>]+')
+
+	def __init__(self, frame):
+		self.frame = frame
+		self.txtw = frame.txtw
+		self.npatches = 0
+		self.patches = []
+		self.reset()
+
+	def reset(self):
+		for p in self.patches:
+			self.txtw.mark_unset(p['start'], p['end'])
+		self.patches = []
+		self.moved = {}
+
+	def _line(self, index):
+		return int(self.txtw.index(index).split('.')[0])
+
+	def _delta(self, p):
+		return self._line(p['end']) - self._line(p['start']) - (p['last'] - p['first'])
+
+	def line_of(self, e):
+		if e in self.moved:
+			p, rel = self.moved[e]
+			return self._line(p['start']) + rel
+		if e.sourceline is None:
+			return None
+		_line = e.sourceline
+		for p in self.patches:
+			if p['first'] is None or e.sourceline < p['last']:
+				continue
+			if e.sourceline > p['first'] or self.follows(e, p['root']):
+				_line += self._delta(p)
+		return _line
+
+	def follows(self, e, root):
+		# e comes after root on the source line root starts on
+		el = e
+		while el is not None and el.sourceline >= root.sourceline:
+			for _sib in el.itersiblings(preceding=True):
+				if _sib is root or _sib in root.iterancestors():
+					return True
+				if _sib.sourceline < root.sourceline:
+					break
+			el = el.getparent()
+		return False
+
+	def qname(self, e):
+		_name = etree.QName(e).localname
+		if e.prefix:
+			_name = u'{}:{}'.format(e.prefix, _name)
+		return _name
+
+	def locate(self, e):
+		# (start, end) text indices of the element or None if it is not where expected
+		if not isinstance(e.tag, basestring):
+			return None
+		_line = self.line_of(e)
+		if _line is None:
+			return None
+		_name = self.qname(e)
+		_nth = self.same_line_before(e, _line, _name)
+		# scan from the line of the nearest element before e on an earlier line, so that
+		# comments, CDATA and processing instructions reaching into e's line are skipped
+		# as a whole and the elements counted by same_line_before are all seen
+		_bound = '1.0'
+		for el in self.preceding(e):
+			if isinstance(el.tag, basestring):
+				_l = self.line_of(el)
+				if _l is not None and _l < _line:
+					_bound = '{}.0'.format(_l)
+					break
+		# the parser reports the line where a start tag ends - count only those ending on _line
+		_first = len(self.txtw.get(_bound, '{}.0'.format(_line)))
+		_last = len(self.txtw.get(_bound, '{}.end'.format(_line)))
+		_start = None
+		for _open, _i, _j, _token in self.tokens(_bound):
+			if _i > _last:
+				break
+			if _open != '<' or _j <= _first:
+				continue
+			m = self.tag_name.match(_token)
+			if m is None or m.group() != _name:
+				continue
+			if _nth:
+				_nth -= 1
+				continue
+			_start = self.txtw.index('{}+{}c'.format(_bound, _i))
+			break
+		if _start is None:
+			return None
+		_end = self.element_end(_start)
+		if _end is None:
+			return None
+		return _start, _end
+
+	def preceding(self, e):
+		# elements that open before e, nearest first
+		el = e
+		while el is not None:
+			for _sib in el.itersiblings(preceding=True):
+				for _el in self.reversed_iter(_sib):
+					yield _el
+			el = el.getparent()
+			if el is not None:
+				yield el
+
+	def reversed_iter(self, e):
+		# e.iter() in reverse document order without materializing it
+		for c in e.iterchildren(reversed=True):
+			for _el in self.reversed_iter(c):
+				yield _el
+		yield e
+
+	def is_after(self, e, other, line):
+		# e comes after other, both opening on line
+		for el in self.preceding(e):
+			if el is other:
+				return True
+			if self.line_of(el) != line:
+				return False
+		return False
+
+	def same_line_before(self, e, line, name):
+		# elements with the same name that open before e on its line
+		_n = 0
+		for el in self.preceding(e):
+			if self.line_of(el) != line:
+				break
+			if isinstance(el.tag, basestring) and self.qname(el) == name:
+				_n += 1
+		return _n
+
+	def tag_close(self, buf, pos):
+		# position of the '>' closing a tag - '>' and '/>' may appear in quoted attribute values
+		_quote = None
+		while True:
+			if _quote:
+				pos = buf.find(_quote, pos)
+				if pos < 0:
+					return -1
+				pos += 1
+				_quote = None
+				continue
+			m = self.tag_delims.search(buf, pos)
+			if m is None:
+				return -1
+			if m.group() == '>':
+				return m.start()
+			_quote = m.group()
+			pos = m.end()
+
+	def tokens(self, start):
+		# markup from the text index start on: (opener, offset, end offset, text between the delimiters)
+		_chunk = 1 << 12
+		_buf = self.txtw.get(start, '{}+{}c'.format(start, _chunk))
+		_eof = False
+		_pos = 0
+		while True:
+			_j = -1
+			_i = _buf.find('<', _pos)
+			if _i < 0:
+				_pos = len(_buf)
+			elif _eof or len(_buf) - _i > len('<![CDATA['):
+				for _open, _close in self.markup:
+					if _buf.startswith(_open, _i):
+						break
+				if _open == '<':
+					_j = self.tag_close(_buf, _i + 1)
+				else:
+					_j = _buf.find(_close, _i + len(_open))
+			if _j < 0:
+				if _eof:
+					return
+				_chunk *= 2
+				_more = self.txtw.get('{}+{}c'.format(start, len(_buf)), '{}+{}c'.format(start, len(_buf) + _chunk))
+				_eof = not _more
+				_buf += _more
+				continue
+			_pos = _j + len(_close)
+			yield _open, _i, _pos, _buf[_i + len(_open):_j]
+
+	def start_tag(self, start):
+		# text of the start tag opening at start
+		for _open, _i, _j, _token in self.tokens(start):
+			return self.txtw.get(start, '{}+{}c'.format(start, _j))
+		return None
+
+	def element_end(self, start):
+		# scan forward from the start tag until the matching end tag
+		_depth = 0
+		for _open, _i, _j, _token in self.tokens(start):
+			if _open != '<':
+				continue
+			if _token.startswith('/'):
+				_depth -= 1
+			elif not _token.endswith('/'):
+				_depth += 1
+			if _depth == 0:
+				return self.txtw.index('{}+{}c'.format(start, _j))
+		return None
+
+	def element_at(self, root, index):
+		# innermost element whose text covers index - descend by line, then verify by text
+		_line = self._line(index)
+		_chain = [root]
+		e = root
+		while len(e):
+			_lo, _hi = 0, len(e)
+			while _lo < _hi:
+				_mid = (_lo + _hi) // 2
+				_l = self.line_of(e[_mid])
+				if _l is not None and _l <= _line:
+					_lo = _mid + 1
+				else:
+					_hi = _mid
+			if _lo == 0:
+				break
+			e = e[_lo - 1]
+			while e is not None and not isinstance(e.tag, basestring):
+				e = e.getprevious()
+			if e is None:
+				break
+			_chain.append(e)
+		for e in reversed(_chain):
+			_range = self.locate(e)
+			if _range and self.txtw.compare(_range[0], '<=', index) and self.txtw.compare(index, '<', _range[1]):
+				return e, _range
+		return None
+
+	def matches(self, e, _range):
+		# whether the text at _range parses to the elements of e - with their tags and attributes
+		_decls = u''.join(u' xmlns{}={}'.format(':' + p if p else '', quoteattr(u))
+						 for p, u in e.nsmap.iteritems())
+		_stext = u'<_{}>{}</_>'.format(_decls, self.txtw.get(*_range))
+		try:
+			_parsed = etree.fromstring(_stext, etree.XMLParser(recover=True))
+		except etree.XMLSyntaxError:
+			return False
+		if _parsed is None or len(_parsed) != 1:
+			return False
+		_elements = lambda x: [(el.tag, dict(el.attrib)) for el in x.iter() if isinstance(el.tag, basestring)]
+		return _elements(_parsed[0]) == _elements(e)
+
+	def patch(self, e, _range, text, rels):
+		# replace the text of e at _range; rels are the line offsets of e.iter() within text
+		_start, _end = _range
+		_cs, _ce = self._line(_start), self._line(_end)
+		_delta = text.count('\n') - (_ce - _cs)
+		_subtree = set(e.iter())
+		_shift = []
+		for el, (p, rel) in self.moved.iteritems():
+			if el in _subtree or self.txtw.compare(p['start'], '>', _start):
+				continue
+			_l = self._line(p['start']) + rel
+			if _l > _ce or (_l == _ce and (_l > _cs or self.is_after(el, e, _l))):
+				_shift.append(el)
+		_reuse = None
+		if e in self.moved and self.moved[e][1] == 0 and self.txtw.compare(self.moved[e][0]['start'], '==', _start):
+			_reuse = self.moved[e][0]
+		_inner = []
+		_after = []
+		for p in self.patches:
+			if p is _reuse:
+				continue
+			if self.txtw.compare(p['start'], '>=', _start) and self.txtw.compare(p['start'], '<', _end):
+				_inner.append(p)
+			elif self.txtw.compare(p['start'], '==', _end):
+				_after.append(p)
+		_first, _last = None, None
+		if _reuse is None and e not in self.moved:
+			_first = _cs - (self.line_of(e) - e.sourceline)
+			_last = _ce - (_cs - _first) - sum([self._delta(p) for p in _inner if p['first'] is not None])
+
+		self.txtw.delete(_start, _end)
+		self.txtw.mark_set('xmlfmt-insert', _start)
+		self.txtw.mark_gravity('xmlfmt-insert', tk.RIGHT)
+		self.frame.insert(text, marker='xmlfmt-insert')
+		_new_end = self.txtw.index('xmlfmt-insert')
+		self.txtw.mark_unset('xmlfmt-insert')
+
+		for p in _inner:
+			self.txtw.mark_unset(p['start'], p['end'])
+			self.patches.remove(p)
+		for p in _after:
+			self.txtw.mark_set(p['start'], _new_end)
+		if _reuse is None:
+			_q = {'start': 'xmlfmt-{}s'.format(self.npatches), 'end': 'xmlfmt-{}e'.format(self.npatches),
+				  'first': _first, 'last': _last, 'root': e}
+			self.npatches += 1
+			self.txtw.mark_set(_q['start'], _start)
+			self.txtw.mark_gravity(_q['start'], tk.LEFT)
+			self.patches.append(_q)
+		else:
+			_q = _reuse
+		self.txtw.mark_set(_q['end'], _new_end)
+		self.txtw.mark_gravity(_q['end'], tk.LEFT)
+		for el in _shift:
+			p, rel = self.moved[el]
+			self.moved[el] = (p, rel + _delta)
+		for el, rel in zip(e.iter(), rels):
+			self.moved[el] = (_q, rel)
+		return _start, _new_end
+
+
+class XMLIndex(object):
+	# compact structure of a document built in one streaming pass with expat
+	# - one entry per element in document order, stored in array columns:
+	#   parent (-1 for the root), depth, tag id, byte offset of the start tag
+	#   and subtree size (number of elements including itself)
+	# - no element objects are kept so it works without building the lxml tree
+	# - origin tells what the offsets count bytes of: the 'file' or the utf-8 encoded 'buffer'
+	def __init__(self, origin='file', max_distinct=1 << 16):
+		self.origin = origin
+		self.max_distinct = max_distinct
+		self.parent = array('l')
+		self.depth = array('i')
+		self.tag = array('i')
+		self.offset = array('l')
+		self.size = array('l')
+		self.tags = []
+		self.tag_ids = {}
+		self.tag_counts = []
+		# attribute name -> [occurrences, set of values or None once max_distinct is reached]
+		self.attributes = {}
+		self._stack = []
+		self._parser = None
+
+	def __len__(self):
+		return len(self.tag)
+
+	def build(self, source, encoding=None):
+		# source is a file object opened in binary mode or a byte string
+		# encoding overrides the one in the xml declaration
+		self._parser = expat.ParserCreate(encoding)
+		self._parser.StartElementHandler = self._start
+		self._parser.EndElementHandler = self._end
+		if hasattr(source, 'read'):
+			self._parser.ParseFile(source)
+		else:
+			self._parser.Parse(source, True)
+		self._parser = None
+		return self
+
+	def _start(self, name, attrs):
+		_tid = self.tag_ids.get(name)
+		if _tid is None:
+			_tid = self.tag_ids[name] = len(self.tags)
+			self.tags.append(name)
+			self.tag_counts.append(0)
+		self.tag_counts[_tid] += 1
+		self.parent.append(self._stack[-1] if self._stack else -1)
+		self.depth.append(len(self._stack))
+		self.tag.append(_tid)
+		self.offset.append(self._parser.CurrentByteIndex)
+		self.size.append(1)
+		self._stack.append(len(self.tag) - 1)
+		for a, v in attrs.iteritems():
+			# expat runs without namespace processing - declarations are not attributes
+			if a == 'xmlns' or a.startswith('xmlns:'):
+				continue
+			_stat = self.attributes.get(a)
+			if _stat is None:
+				_stat = self.attributes[a] = [0, set()]
+			_stat[0] += 1
+			if _stat[1] is not None:
+				_stat[1].add(v)
+				if len(_stat[1]) > self.max_distinct:
+					_stat[1] = None
+
+	def _end(self, name):
+		i = self._stack.pop()
+		self.size[i] = len(self.tag) - i
+
+	def tag_histogram(self):
+		return sorted(zip(self.tags, self.tag_counts), key=lambda x: -x[1])
+
+	def depth_histogram(self):
+		return sorted(collections.Counter(self.depth).iteritems())
+
+	def largest_subtrees(self, n=10):
+		# skip the root - it is always the largest
+		return heapq.nlargest(n, xrange(1, len(self.size)), key=self.size.__getitem__)
+
+	def attribute_cardinalities(self):
+		# (name, occurrences, distinct values or None if more than max_distinct)
+		_card = []
+		for a, (_count, _values) in self.attributes.iteritems():
+			_card.append((a, _count, len(_values) if _values is not None else None))
+		return sorted(_card, key=lambda x: -x[1])
+
+
+class XMLStatsView(tk.Frame, WithCallback):
+	def __init__(self, parent, *args, **kwargs):
+		WithCallback.__init__(self, parent, *args, **kwargs)
+		self.build_index = self.get_pop_kwargs('build_index', None)
+		self.top = self.get_pop_kwargs('top', 20)
+		tk.Frame.__init__(self, parent, *args, **self.kwargs)
+		self.pack(fill="both", expand=True)
+		self.grid_propagate(False)
+		self.grid_rowconfigure(0, weight=1)
+		self.grid_columnconfigure(0, weight=1)
+		self.tview = ttk.Treeview(self, columns=('count',))
+		self.tview.heading('#0', text="Statistics")
+		self.tview.heading('count', text="Count")
+		self.tview.grid(row=0, column=0, sticky='nsew', padx=2, pady=2)
+		scrollb = tk.Scrollbar(self, command=self.tview.yview)
+		scrollb.grid(row=0, column=1, sticky='nsew')
+		self.tview['yscrollcommand'] = scrollb.set
+		self.xml_index = None
+		self.bind("<Visibility>", self.on_visibility)
+
+	def reset(self):
+		# the document changed - build the index again when shown
+		self.xml_index = None
+		for i in self.tview.get_children():
+			self.tview.delete(i)
+
+	def add_section(self, text, rows):
+		_sec = self.tview.insert('', 'end', text=text, open=True)
+		for _text, _count in rows:
+			self.tview.insert(_sec, 'end', text=_text, values=(_count,))
+
+	def update(self, new_index=None):
+		for i in self.tview.get_children():
+			self.tview.delete(i)
+		if new_index is not None:
+			self.xml_index = new_index
+		_index = self.xml_index
+		if _index is None:
+			return
+		self.add_section('elements', [('total', len(_index)), ('distinct tags', len(_index.tags))])
+		self.add_section('tags', _index.tag_histogram()[:self.top])
+		self.add_section('depth', [(u'depth {}'.format(d), n) for d, n in _index.depth_histogram()])
+		_rows = []
+		for i in _index.largest_subtrees(self.top):
+			_rows.append((u'{} at {} byte {} depth {}'.format(_index.tags[_index.tag[i]], _index.origin, _index.offset[i], _index.depth[i]), _index.size[i]))
+		self.add_section('largest subtrees', _rows)
+		_rows = []
+		for a, _count, _distinct in _index.attribute_cardinalities()[:self.top]:
+			if _distinct is None:
+				_rows.append((u'{} (> {} distinct values)'.format(a, _index.max_distinct), _count))
+			else:
+				_rows.append((u'{} ({} distinct values)'.format(a, _distinct), _count))
+		self.add_section('attributes', _rows)
+
+	def on_visibility(self, event):
+		if self.xml_index is None and self.build_index:
+			self.update(self.build_index())
+
 
 class XMLEditor(tk.Frame, WithCallback):
 	def __init__(self, parent, pargs, *args, **kwargs):
@@ -454,6 +944,7 @@ class XMLEditor(tk.Frame, WithCallback):
 		self.grid_columnconfigure(0, weight=1)
 		self.grid_columnconfigure(1, weight=1)
 		self.grid_columnconfigure(2, weight=1)
+		self.grid_columnconfigure(3, weight=1)
 
 		self.tabs = ttk.Notebook(self)
 		self.tabs.grid(row=0, column=0, columnspan=4, sticky=tk.N + tk.S + tk.W + tk.E)
@@ -469,6 +960,11 @@ class XMLEditor(tk.Frame, WithCallback):
 		self.edit.setup(font_size=12, font_name='fixed')
 		self.edit_text_tab.pack(fill="both", expand=True)
 		self.tabs.add(self.edit_text_tab, text='Edit File')
+
+		self.stats_tab = ttk.Frame(self.tabs)
+		self.stats = XMLStatsView(self.stats_tab, build_index=self.build_index)
+		self.stats_tab.pack(fill="both", expand=True)
+		self.tabs.add(self.stats_tab, text='Statistics')
 		# self.tabs.pack(expand=1, fill="both")
 		# testing = not needed
 		# self.tabs.bind("<<NotebookTabChanged>>", lambda event: event.widget.winfo_children()[event.widget.index("current")].update())
@@ -485,9 +981,12 @@ class XMLEditor(tk.Frame, WithCallback):
 		self.button_xml = tk.Button(self, text='Parse XML', command=self.update_xml_string)
 		self.button_xml.grid(row=1, column=1, columnspan=1, sticky=_sticky_button_expand)
 
+		self.button_reformat = tk.Button(self, text='Reformat', command=self.reformat)
+		self.button_reformat.grid(row=1, column=2, columnspan=1, sticky=_sticky_button_expand)
+
 		self.fname = pargs.fname
 		self.label_xml = tk.Label(self, text='{}'.format(os.path.basename(self.fname)))
-		self.label_xml.grid(row=1, column=2, columnspan=1, sticky=_sticky_button_expand)
+		self.label_xml.grid(row=1, column=3, columnspan=1, sticky=_sticky_button_expand)
 
 		self.button_save = tk.Button(self, text='Save', command=self.save)
 		self.button_save.grid(row=2, column=0, columnspan=1, sticky=_sticky_button_expand)
@@ -500,8 +999,17 @@ class XMLEditor(tk.Frame, WithCallback):
 
 		self.sgrip = ttk.Sizegrip(self).grid(column=999, row=999, sticky=(tk.S, tk.E))
 
-		self.xml_parser = etree.XMLParser(ns_clean=True, remove_blank_text=True)
+		# preserve formatting: parse the text as is and never re-serialize the whole document
+		self.preserve_format = getattr(pargs, 'preserve', False)
+		# low memory: the lxml tree is not built on open - only the streaming index
+		self.low_memory = getattr(pargs, 'low_memory', False)
+		# the file on disk matches the text until it is parsed, reformatted or edited
+		self.index_from_file = self.low_memory
+		self.xml_parser = etree.XMLParser(ns_clean=True, remove_blank_text=not self.preserve_format, strip_cdata=not self.preserve_format)
 		self.xml_root = None
+		self.source_map = XMLSourceMap(self.edit)
+		self.source_map_valid = False
+		self.edit.txtw.bind('<<Modified>>', self.on_modified)
 		self.xml_string = '<?xml version="1.0"?>\n<root>\n<test>not much here</test>\n</root>'
 		self.check_output()
 		if self.fname:
@@ -509,7 +1017,15 @@ class XMLEditor(tk.Frame, WithCallback):
 		else:
 			if pargs.xml_string:
 				self.xml_string = pargs.xml_string
-		self.process_xml()
+		if self.preserve_format or self.low_memory:
+			self.edit.reset_text(self.xml_string)
+		if self.low_memory:
+			self.edit.txtw.edit_modified(False)
+			self.stats.update(self.build_index())
+			if self.stats.xml_index is not None:
+				self.tag_list.update_option_menu(self.stats.xml_index.tags)
+		else:
+			self.process_xml()
 		self.update_tags(self.tag_list)
 
 	def check_output(self):
@@ -558,18 +1074,39 @@ class XMLEditor(tk.Frame, WithCallback):
 			if _confirm:
 				pass
 
-	def update_xml_string(self):
+	def on_modified(self, event):
+		# the event is queued - parsing and reformatting have cleared the flag by the time it runs
+		if not self.edit.txtw.edit_modified():
+			return
+		# typed text: the line numbers of the tree and the statistics are out of date
+		self.source_map_valid = False
+		self.index_from_file = False
+		self.stats.reset()
+		# clear the flag so that the next edit generates the event again
+		self.edit.txtw.edit_modified(False)
+
+	def update_xml_string(self, reformat=None):
 		self.xml_string = self.edit.txtw.get(1.0, tk.END)
-		self.process_xml()
+		self.process_xml(reformat)
 		self.update_tags(self.tag_list)
 
-	def process_xml(self):
+	def process_xml(self, reformat=None):
+		if reformat is None:
+			reformat = not self.preserve_format
 		try:
 			self.xml_root = etree.XML(self.xml_string, self.xml_parser)
 			self.tview.update(self.xml_root)
-			_preamb = self.xml_string.find('<{}>'.format(self.xml_root.tag))
-			self.xml_string = '{}{}'.format(self.xml_string[:_preamb], etree.tostring(self.xml_root, pretty_print=True, method="xml"))
-			self.edit.reset_text(self.xml_string)
+			self.source_map.reset()
+			self.stats.reset()
+			self.index_from_file = False
+			# line numbers of the tree refer to the text just parsed
+			self.source_map_valid = not reformat
+			if reformat:
+				_preamb = self.xml_string.find('<{}>'.format(self.xml_root.tag))
+				self.xml_string = '{}{}'.format(self.xml_string[:_preamb], etree.tostring(self.xml_root, pretty_print=True, method="xml"))
+				self.edit.reset_text(self.xml_string)
+			# edits typed from here on make the line numbers of the tree unreliable
+			self.edit.txtw.edit_modified(False)
 			self.tag_list.update_option_menu(self.tview.xml_tags)
 			self.update_tags(self.tag_list)
 		except etree.XMLSyntaxError as e:
@@ -578,6 +1115,88 @@ class XMLEditor(tk.Frame, WithCallback):
 				pass
 
 
+	def reformat(self):
+		# pretty-print only the element selected in the tree view (or the one under
+		# the cursor in the editor) and patch its text range in place
+		e = None
+		_path = None
+		if self.tabs.index('current') == self.tabs.index(self.edit_tags_tab):
+			e = self.tview.selected_element()
+			if e is None:
+				return
+		if self.edit.txtw.edit_modified():
+			# typed since the last <<Modified>> event was handled
+			self.source_map_valid = False
+		if not self.source_map_valid:
+			# the text was pretty-printed or edited after parsing - parse it again as it is
+			if e is not None:
+				_path = e.getroottree().getpath(e)
+			self.update_xml_string(reformat=False)
+			if not self.source_map_valid:
+				return
+			if _path:
+				e = next(iter(self.xml_root.getroottree().xpath(_path)), None)
+		_found = None
+		if _path or e is not None:
+			_range = e is not None and self.source_map.locate(e)
+			if _range:
+				_found = e, _range
+		else:
+			_found = self.source_map.element_at(self.xml_root, self.edit.txtw.index(tk.INSERT))
+		if _found is None:
+			_confirm = tkMessageBox.showerror('Failed reformatting', 'element not found in the text - try Parse XML first')
+			if _confirm:
+				pass
+			return
+		e, _range = _found
+		if not self.source_map.matches(e, _range):
+			# never replace text that is not the element
+			_confirm = tkMessageBox.showerror('Failed reformatting', u'the text found for <{}> does not match it - try Parse XML first'.format(self.source_map.qname(e)))
+			if _confirm:
+				pass
+			return
+		_indent = self.edit.txtw.get('{} linestart'.format(_range[0]), _range[0])
+		if _indent.strip():
+			_indent = ''
+		indent_xml(e, _indent)
+		_stext = etree.tostring(e, with_tail=False, encoding='unicode')
+		_rels = [el.sourceline - 1 for el in etree.fromstring(_stext).iter()]
+		# tostring declares the inherited namespaces on the subtree - keep only those already in the text
+		_start_tag = self.source_map.start_tag(_range[0])
+		_decls = [m.group(1, 3) for m in re.finditer(r'xmlns(:[\w.-]+)?\s*=\s*(["\'])(.*?)\2', _start_tag)]
+		_istart_end = _stext.find('>')
+		_stext_start = re.sub(r'\s+xmlns(:[\w.-]+)?="([^"]*)"',
+							  lambda m: m.group(0) if m.group(1, 2) in _decls else '', _stext[:_istart_end])
+		_stext = _stext_start + _stext[_istart_end:]
+		_range = self.source_map.patch(e, _range, _stext, _rels)
+		self.edit.txtw.edit_modified(False)
+		# byte offsets of the index are off now
+		self.index_from_file = False
+		self.stats.reset()
+		self.edit.txtw.see(_range[0])
+
+	def build_index(self):
+		# in low memory mode stream the file from disk as long as the text is
+		# the file as opened, otherwise index the text being edited
+		_index = XMLIndex()
+		try:
+			if self.index_from_file and os.path.isfile(self.fname):
+				with open(self.fname, 'rb') as f:
+					_index.build(f)
+			else:
+				_index = XMLIndex(origin='buffer')
+				_stext = self.edit.txtw.get(1.0, tk.END)
+				if isinstance(_stext, unicode):
+					_stext = _stext.encode('utf-8')
+				_index.build(_stext, encoding='utf-8')
+		except expat.ExpatError as e:
+			_confirm = tkMessageBox.showerror('Failed indexing XML', '{}'.format(str(e)))
+			if _confirm:
+				pass
+			return None
+		logger.debug('indexed {} elements'.format(len(_index)))
+		return _index
+
 	def save(self):
 		with open(self.fname, 'w') as f:
 			stext = self.edit.txtw.get(1.0, tk.END)
@@ -637,6 +1256,8 @@ if __name__ == '__main__':
 	parser.add_argument('fname', help='file name to process', default='default.xml', nargs='?')
 	parser.add_argument('-g', '--debug', help='debug on', default=False, action='store_true')
 	parser.add_argument('-t', '--text', help='strings to process', default='')
+	parser.add_argument('-l', '--low-memory', help='do not build the xml tree on open - statistics only from a streaming index', default=False, action='store_true')
+	parser.add_argument('-p', '--preserve', help='preserve formatting - do not pretty-print the whole file on parse', default=False, action='store_true')
 
 	args = parser.parse_args()
 